@@ -1,7 +1,12 @@
 import streamlit as st
-import yfinance as yf
 import pandas as pd
+import numpy as np
 from datetime import date
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import io
+import os
 import time
 
 # --- 1. PAGE CONFIGURATION ---
@@ -9,15 +14,33 @@ st.set_page_config(page_title="DiviTrack | Dividend Auditor", layout="wide")
 
 # --- 2. HELPER FUNCTIONS ---
 
-@st.cache_data
+@st.cache_resource(show_spinner=False)
 def load_stock_map():
     """
     Reads the local 'EQUITY_L.csv' file AND adds REITs/InvITs to the search list.
+    The finished table is saved to 'EQUITY_L.feather' so later cold starts skip the CSV parse.
     """
     try:
+        # 0. Fast path: reuse the Feather copy if it is not older than the CSV or this
+        #    script (which holds the REIT list and the column handling)
+        sources_mtime = max(os.path.getmtime("EQUITY_L.csv"), os.path.getmtime(__file__))
+        if os.path.exists("EQUITY_L.feather") and os.path.getmtime("EQUITY_L.feather") >= sources_mtime:
+            try:
+                return pd.read_feather("EQUITY_L.feather", use_threads=True)
+            except Exception:
+                # Unreadable copy: rebuild it from the CSV below
+                pass
+        
         # 1. Load standard equities from the CSV
         # 'on_bad_lines' skips messy rows if the CSV is imperfect.
-        df = pd.read_csv("EQUITY_L.csv", on_bad_lines='skip')
+        # Only the two columns we search on are parsed, as plain strings (no type inference).
+        df = pd.read_csv(
+            "EQUITY_L.csv",
+            usecols=lambda c: c.strip() in {'NAME OF COMPANY', 'SYMBOL'},
+            dtype='string',
+            engine='c',
+            on_bad_lines='skip'
+        )
         
         # Standardize columns (remove extra spaces)
         df.columns = [c.strip() for c in df.columns]
@@ -35,19 +58,138 @@ def load_stock_map():
         ]
         
         # 3. Combine standard stocks with REITs
-        df_reits = pd.DataFrame(reits_data)
+        df_reits = pd.DataFrame(reits_data, dtype='string')
         # Use concat to merge them
         df = pd.concat([df, df_reits], ignore_index=True)
         
-        # 4. Create the search label: "Wipro Ltd (WIPRO)"
-        df['Search_Label'] = df['NAME OF COMPANY'] + " (" + df['SYMBOL'] + ")"
+        # 4. Save the finished table for the next cold start
+        # Written to a temp file and swapped in, so a failed write never leaves a truncated copy
+        try:
+            df.to_feather("EQUITY_L.feather.tmp")
+            os.replace("EQUITY_L.feather.tmp", "EQUITY_L.feather")
+        except Exception:
+            # Read-only or full disk: keep serving from the CSV
+            try:
+                os.remove("EQUITY_L.feather.tmp")
+            except OSError:
+                pass
         return df
     except Exception:
         # Returns empty if file is missing or unreadable
         return pd.DataFrame()
 
+@st.cache_resource(show_spinner=False)
+def load_symbol_names():
+    """
+    Maps each SYMBOL to its company name, e.g. "WIPRO" -> "Wipro Ltd".
+    The dropdown offers the symbols and shows "Wipro Ltd (WIPRO)" via this lookup.
+    """
+    df = load_stock_map()
+    if df.empty:
+        return {}
+    return dict(zip(df['SYMBOL'], df['NAME OF COMPANY']))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_dividends(ticker):
+    """
+    Fetches the dividend history for one symbol, cached per ticker so
+    reruns (tax slab, TDS toggle) don't hit Yahoo again.
+    Backs off exponentially (1s, 2s, 4s) only when Yahoo rate-limits us.
+    """
+    # Imported lazily: yfinance is heavy and only needed once a portfolio is scanned
+    import yfinance as yf
+    from yfinance.exceptions import YFRateLimitError
+    
+    for retry in range(4):
+        try:
+            div_history = yf.Ticker(ticker).dividends
+            break
+        except YFRateLimitError:
+            if retry == 3:
+                raise
+            time.sleep(2 ** retry)
+    return div_history
+
+def scan_portfolio(portfolio_key):
+    """
+    Scans a hashable portfolio snapshot of (ticker, name, qty, buy_date) entries.
+    Returns the payout table and any fetch errors. The caller memoizes the result
+    in session state, so tax toggles reuse it without a process-wide cache.
+    """
+    frames = []
+    errors = []
+    
+    # Group lots by ticker: a stock bought twice (e.g. averaging down) is fetched once
+    lots_by_ticker = defaultdict(list)
+    for ticker, name, qty, buy_date in portfolio_key:
+        lots_by_ticker[ticker].append((name, qty, buy_date))
+    
+    # Fetch every stock in parallel: each call is independent network I/O,
+    # and a small pool keeps us polite towards Yahoo's rate limits.
+    # Workers inherit this script's context, so cached fetches run in them quietly
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=8, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        futures = {executor.submit(fetch_dividends, ticker): ticker for ticker in lots_by_ticker}
+        
+        for future in as_completed(futures):
+            ticker = futures[future]
+            lots = lots_by_ticker[ticker]
+            
+            try:
+                div_history = future.result()
+                
+                if div_history.empty:
+                    print(f"No data for {ticker}")
+                    continue
+                
+                # --- FIX FOR TIMEZONE ERROR ---
+                # Yahoo's index is timezone-aware: localize 'buy_date' to match it
+                # rather than rewriting the whole index
+                tz = div_history.index.tz
+                
+                for name, qty, buy_date in lots:
+                    start = buy_date.tz_localize(tz) if tz is not None else buy_date
+                    
+                    # CORE LOGIC
+                    # Yahoo returns the history sorted by date: binary-search the first
+                    # ex-date strictly after buy_date and keep everything from there.
+                    my_dividends = div_history.iloc[div_history.index.searchsorted(start, side='right'):]
+                    
+                    if not my_dividends.empty:
+                        # One frame per lot, built column-wise instead of row by row
+                        frames.append(pd.DataFrame({
+                            "Stock": name,
+                            "Symbol": ticker,
+                            "Ex-Date": my_dividends.index.tz_localize(None),
+                            "Dividend/Share": my_dividends.to_numpy(),
+                            "Qty": qty,
+                            "Total Payout": (my_dividends * qty).round(2).to_numpy()
+                        }))
+                
+            except Exception as e:
+                errors.append(f"Could not fetch data for {lots[0][0]} ({ticker}). Error: {e}")
+    
+    if not frames:
+        return pd.DataFrame(), errors
+    
+    # Stitch the per-stock frames together once; sort on native datetime64 ex-dates,
+    # then show them as plain calendar dates
+    df_results = pd.concat(frames, ignore_index=True).sort_values(by="Ex-Date", ascending=False)
+    df_results['Ex-Date'] = df_results['Ex-Date'].dt.date
+    return df_results, errors
+
+def to_csv_bytes(df):
+    """
+    Writes the transaction log straight into a bytes buffer for download.
+    Not cached: a few hundred rows are cheap to serialize, and users'
+    statements shouldn't outlive their session in server memory.
+    """
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding='utf-8')
+    return buf.getvalue()
+
 # Load the data once
-stock_map_df = load_stock_map()
+sym_to_name = load_symbol_names()
 
 # --- 3. DISCLAIMER & PRIVACY ---
 st.warning("""
@@ -60,8 +202,9 @@ st.warning("""
 st.success("🔒 **Privacy Notice:** Your data is processed locally in RAM. It is never stored, saved, or shared. Refreshing this page wipes all data.")
 
 # Initialize Session State
+# One row per lot, stored column-wise so the scan can read it as plain tuples
 if 'portfolio' not in st.session_state:
-    st.session_state.portfolio = []
+    st.session_state.portfolio = pd.DataFrame(columns=["Ticker", "Name", "Qty", "BuyDate"])
 
 # --- 4. SIDEBAR: SMART INPUTS ---
 st.sidebar.header("💰 Add to Portfolio")
@@ -73,23 +216,19 @@ with st.sidebar.form("add_stock_form"):
     selected_stock_name = None
     
     # Check if we successfully loaded the CSV list
-    if not stock_map_df.empty:
+    if sym_to_name:
         user_selection = st.selectbox(
             "Search Stock Name", 
-            stock_map_df['Search_Label'],
+            list(sym_to_name),
             index=None,
+            format_func=lambda s: f"{sym_to_name[s]} ({s})",
             placeholder="Type 'Zomato' or 'Embassy'..."
         )
         
         if user_selection:
-            # EXTRACT SYMBOL LOGIC
-            try:
-                # "The Federal Bank Ltd (FEDERALBNK)" -> "FEDERALBNK"
-                clean_symbol = user_selection.split("(")[-1].replace(")", "").strip()
-                selected_ticker_symbol = f"{clean_symbol}.NS"
-                selected_stock_name = user_selection.split("(")[0].strip()
-            except:
-                st.error("Error parsing stock name. Please use manual entry.")
+            # The option itself is the symbol, e.g. "FEDERALBNK"
+            selected_ticker_symbol = f"{user_selection}.NS"
+            selected_stock_name = sym_to_name[user_selection]
             
     else:
         # FALLBACK: If CSV is missing, show manual text box
@@ -109,19 +248,21 @@ with st.sidebar.form("add_stock_form"):
     
     if submitted:
         if selected_ticker_symbol:
-            st.session_state.portfolio.append({
+            portfolio = st.session_state.portfolio
+            portfolio.loc[len(portfolio)] = {
                 "Ticker": selected_ticker_symbol,
                 "Name": selected_stock_name,
                 "Qty": qty_input,
-                "BuyDate": buy_date_input
-            })
+                # Stored as a pandas timestamp once, so the scan can compare it directly
+                "BuyDate": pd.Timestamp(buy_date_input)
+            }
             st.success(f"Added {selected_stock_name}")
         else:
             st.error("Please select or enter a stock.")
 
 # Clear Button
 if st.sidebar.button("🗑️ Clear Portfolio"):
-    st.session_state.portfolio = []
+    st.session_state.portfolio = st.session_state.portfolio.iloc[0:0]
     st.rerun()
 
 # --- 5. MAIN LOGIC ---
@@ -129,100 +270,74 @@ st.title("💸 DiviTrack: Dividend Tax & Eligibility Calculator")
 st.markdown("This tool scans historical data to calculate your **Real In-Hand Profit** after TDS and Tax Slabs.")
 
 # --- 6. TAX SETTINGS ---
-st.subheader("⚙️ Tax Configuration")
-col_tax1, col_tax2 = st.columns(2)
-with col_tax1:
-    tax_slab = st.selectbox("Select Your Income Tax Slab", [0, 10, 20, 30], index=3, format_func=lambda x: f"{x}% Slab")
-with col_tax2:
-    apply_tds = st.checkbox("Apply 10% TDS?", value=True, help="TDS is deducted if dividend > ₹5,000")
-
-# --- 7. PROCESSING ENGINE ---
-if len(st.session_state.portfolio) > 0:
-    st.divider()
-    
-    total_gross_dividend = 0
-    all_payouts = []
+@st.fragment
+def render_results():
+    """
+    Tax settings, scan and results. Runs as a fragment, so changing the slab
+    or TDS reruns only this block instead of the whole page.
+    """
+    st.subheader("⚙️ Tax Configuration")
+    col_tax1, col_tax2 = st.columns(2)
+    with col_tax1:
+        tax_slab = st.selectbox("Select Your Income Tax Slab", [0, 10, 20, 30], index=3, format_func=lambda x: f"{x}% Slab")
+    with col_tax2:
+        apply_tds = st.checkbox("Apply 10% TDS?", value=True, help="TDS is deducted if dividend > ₹5,000")
 
-    progress_text = "Scanning secure data streams..."
-    my_bar = st.progress(0, text=progress_text)
+    # --- 7. PROCESSING ENGINE ---
+    if len(st.session_state.portfolio) > 0:
+        st.divider()
     
-    total_stocks = len(st.session_state.portfolio)
+        # Hashable snapshot of the portfolio: only editing it triggers a rescan
+        portfolio_key = tuple(st.session_state.portfolio.itertuples(index=False, name=None))
+        # Memoized in this session only, so holdings never sit in a process-wide cache;
+        # tax toggles reuse the scan and only portfolio edits trigger a new one
+        if st.session_state.get('scan_key') != portfolio_key:
+            with st.spinner("Scanning secure data streams..."):
+                st.session_state.scan_result = scan_portfolio(portfolio_key)
+            # A partial scan isn't kept: the next rerun retries the failed stocks
+            st.session_state.scan_key = None if st.session_state.scan_result[1] else portfolio_key
+        df_results, errors = st.session_state.scan_result
     
-    for i, item in enumerate(st.session_state.portfolio):
-        ticker = item['Ticker']
-        name = item.get('Name', ticker) 
-        qty = item['Qty']
-        
-        # Ensure buy_date is a pandas timestamp
-        buy_date = pd.to_datetime(item['BuyDate'])
-        
-        # Rate Limiting
-        time.sleep(0.1) 
-        my_bar.progress((i + 1) / total_stocks, text=f"Verifying {name}...")
-        
-        try:
-            stock = yf.Ticker(ticker)
-            div_history = stock.dividends
-            
-            if div_history.empty:
-                print(f"No data for {ticker}")
-            else:
-                # --- FIX FOR TIMEZONE ERROR ---
-                # Remove timezone awareness from Yahoo data so it matches 'buy_date'
-                div_history.index = div_history.index.tz_localize(None)
-                
-                # CORE LOGIC
-                my_dividends = div_history[div_history.index > buy_date]
-                
-                if not my_dividends.empty:
-                    for date_val, amount in my_dividends.items():
-                        payout = amount * qty
-                        total_gross_dividend += payout
-                        
-                        all_payouts.append({
-                            "Stock": name,
-                            "Symbol": ticker,
-                            "Ex-Date": date_val.date(),
-                            "Dividend/Share": f"₹{amount}",
-                            "Qty": qty,
-                            "Total Payout": round(payout, 2)
-                        })
-            
-        except Exception as e:
-            st.error(f"Could not fetch data for {name} ({ticker}). Error: {e}")
-
-    my_bar.empty()
-
-    # --- 8. RESULTS ---
-    tds_amount = total_gross_dividend * 0.10 if apply_tds else 0
-    income_tax_amount = total_gross_dividend * (tax_slab / 100)
-    final_in_hand = total_gross_dividend - income_tax_amount
-
-    # Metrics
-    m1, m2, m3, m4 = st.columns(4)
-    m1.metric("Total Dividend", f"₹{total_gross_dividend:,.2f}")
-    m2.metric("Est. TDS (10%)", f"₹{tds_amount:,.2f}")
-    m3.metric("Tax Liability", f"₹{income_tax_amount:,.2f}", f"{tax_slab}% Slab")
-    m4.metric("Net Profit", f"₹{final_in_hand:,.2f}", delta="In Hand")
-
-    # --- 9. EXPORT DATA ---
-    st.subheader("📝 Transaction Log")
-    if all_payouts:
-        df_results = pd.DataFrame(all_payouts).sort_values(by="Ex-Date", ascending=False)
-        st.dataframe(df_results, use_container_width=True)
+        for error in errors:
+            st.error(error)
+    
+        total_gross_dividend = df_results['Total Payout'].sum() if not df_results.empty else 0
+
+        # --- 8. RESULTS ---
+        # TDS, income tax and in-hand share of the gross, applied in one multiply
+        rates = np.array([0.10 if apply_tds else 0.0, tax_slab / 100, 1 - tax_slab / 100])
+        tds_amount, income_tax_amount, final_in_hand = total_gross_dividend * rates
+
+        # Metrics
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Total Dividend", f"₹{total_gross_dividend:,.2f}")
+        m2.metric("Est. TDS (10%)", f"₹{tds_amount:,.2f}")
+        m3.metric("Tax Liability", f"₹{income_tax_amount:,.2f}", f"{tax_slab}% Slab")
+        m4.metric("Net Profit", f"₹{final_in_hand:,.2f}", delta="In Hand")
+
+        # --- 9. EXPORT DATA ---
+        st.subheader("📝 Transaction Log")
+        if not df_results.empty:
+            # Amounts stay numeric (sortable, spreadsheet-friendly); rupees are display-only
+            st.dataframe(
+                df_results.style.format({"Dividend/Share": lambda v: f"₹{v}", "Total Payout": "₹{:,.2f}"}),
+                use_container_width=True
+            )
         
-        csv = df_results.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="📥 Download for Tax Filing",
-            data=csv,
-            file_name='dividend_statement.csv',
-            mime='text/csv',
-        )
+            csv = to_csv_bytes(df_results)
+            st.download_button(
+                label="📥 Download for Tax Filing",
+                data=csv,
+                file_name='dividend_statement.csv',
+                mime='text/csv',
+            )
+        else:
+            st.info("No dividends found since purchase date.")
+
     else:
-        st.info("No dividends found since purchase date.")
+        st.info("👈 Use the smart search in the sidebar to add stocks.")
 
-else:
-    st.info("👈 Use the smart search in the sidebar to add stocks.")
+render_results()
 
 # --- FOOTER ---
 st.markdown("---")